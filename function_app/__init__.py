@@ -1,9 +1,20 @@
+import io
 import os
-import json
+import re
+import asyncio
+import functools
 import logging
+import time
 import datetime as dt
+from operator import itemgetter
+from typing import Callable
+import cachetools
+import faiss
+import httpx
+import numpy as np
+import orjson
+import tiktoken
 import azure.functions as func
-import requests
 
 """
 This module implements the main HTTP triggered function for the AIOps agent.
@@ -45,46 +56,149 @@ KQL_QUERY=<Kusto query to sample logs>
 SEARCH_ENDPOINT=<https endpoint for Cognitive Search>
 SEARCH_INDEX=<name of the search index>
 SEARCH_API_KEY=<Cognitive Search admin/query key>
+SEARCH_VECTOR_FIELD=<optional HNSW vector field; enables hybrid search when set>
 OPENAI_ENDPOINT=<Azure OpenAI resource endpoint>
 OPENAI_API_KEY=<API key for OpenAI>
 OPENAI_DEPLOYMENT=<deployment name, e.g. gpt-4o>
+OPENAI_EMBEDDING_DEPLOYMENT=<optional embedding deployment; enables the RAG semantic cache when set>
 TEAMS_WEBHOOK_URL=<incoming Teams webhook URL>
 REMEDIATION_URL=<HTTP endpoint for remediation function>
 REMEDIATION_KEY=<optional function key for remediation>
+PRETTY_JSON=<optional, set to 1 to indent the HTTP response body>
 ```
 
 See the README in the repository for a full walk‑through of how to
 configure these services.
 """
 
-# Azure Monitor Logs client dependencies
-from azure.identity import DefaultAzureCredential
-from azure.monitor.query import LogsQueryClient, LogsQueryStatus
+# Azure Monitor Logs client dependencies (async variants so the KQL and
+# RAG legs can run concurrently)
+from azure.identity.aio import DefaultAzureCredential
+from azure.monitor.query import LogsQueryStatus
+from azure.monitor.query.aio import LogsQueryClient
 
 # Azure Cognitive Search client
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizedQuery
 
 # Azure OpenAI
-import openai
+from openai import AsyncAzureOpenAI
+
+# A single Azure AD credential is shared by every Azure SDK client so its
+# token cache is reused; the VS Code credential is excluded so the chain
+# does not probe it in production.
+_CRED = DefaultAzureCredential(exclude_visual_studio_code_credential=True)
+
+# Clients are created lazily on first use and reused across warm
+# invocations of the worker so pooled TCP/TLS connections are amortised.
+# Search and OpenAI clients are keyed by their configuration so a settings
+# change picks up a fresh client.
+_LOGS: LogsQueryClient | None = None
+_SEARCH: dict[tuple[str, str, str], SearchClient] = {}
+_OPENAI: dict[tuple[str, str], AsyncAzureOpenAI] = {}
+
+# Shared HTTP/2 client for the remediation endpoint and the Teams webhook;
+# keep-alive connections survive across invocations of a warm worker.  The
+# idle expiry is raised from httpx's 5 s default so the TLS session to the
+# Teams webhook host outlives the gap between typical invocations.
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=20,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=75),
+)
+
+
+def _get_logs_client() -> LogsQueryClient:
+    """Return the shared Log Analytics query client."""
+    global _LOGS
+    if _LOGS is None:
+        _LOGS = LogsQueryClient(credential=_CRED)
+    return _LOGS
+
+
+def _get_search_client(endpoint: str, index_name: str, api_key: str) -> SearchClient:
+    """Return the shared Cognitive Search client for the given index."""
+    key = (endpoint, index_name, api_key)
+    client = _SEARCH.get(key)
+    if client is None:
+        client = SearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(api_key),
+        )
+        _SEARCH[key] = client
+    return client
+
+
+def _get_openai_client(endpoint: str, api_key: str) -> AsyncAzureOpenAI:
+    """Return the shared Azure OpenAI client for the given resource."""
+    key = (endpoint, api_key)
+    client = _OPENAI.get(key)
+    if client is None:
+        client = AsyncAzureOpenAI(
+            azure_endpoint=endpoint,
+            api_key=api_key,
+            api_version="2024-02-01",
+        )
+        _OPENAI[key] = client
+    return client
+
+
+# Only a small preview of the logs is sent to the LLM, so column pruning
+# and truncation are pushed into Kusto rather than done in Python.  The
+# default query prunes columns itself; custom queries may return any
+# schema, so they only get a row limit appended when they lack one.
+_KQL_PREVIEW_ROWS = 20
+_DEFAULT_KQL_QUERY = (
+    "AppTraces | where Timestamp > ago(30m) "
+    f"| project Timestamp, Message, SeverityLevel | top {_KQL_PREVIEW_ROWS} by Timestamp desc"
+)
+_KQL_HAS_LIMIT = re.compile(r"\|\s*(?:top|take|limit)\s")
+
+
+def _shape_kql(query: str) -> str:
+    """Append a ``take`` row limit to a query unless it already has a
+    ``top``, ``take`` or ``limit`` operator.
+    """
+    query = query.rstrip().rstrip(";")
+    if not _KQL_HAS_LIMIT.search(query):
+        query = f"{query} | take {_KQL_PREVIEW_ROWS}"
+    return query
+
+
+def _empty_logs() -> dict:
+    """Return an empty columnar log sample."""
+    return {"columns": [], "rows": []}
+
+
+async def _no_logs() -> dict:
+    """Stand-in for the KQL leg when no workspace is configured."""
+    return _empty_logs()
+
+
+async def _no_results() -> list[dict]:
+    """Stand-in for the RAG leg when no search index is configured."""
+    return []
 
 
-def _run_kql(workspace_id: str, query: str) -> list[dict]:
+async def _run_kql(workspace_id: str, query: str) -> dict:
     """Query Log Analytics for recent logs.
 
-    Returns a list of dictionaries mapping column names to values.
+    Returns the result table in columnar form, ``{"columns": [...],
+    "rows": [[...], ...]}``.  The rows are only ever serialised as a
+    prompt preview, so no per-row dictionaries are built.
     """
-    credential = DefaultAzureCredential()
-    client = LogsQueryClient(credential=credential)
     try:
-        resp = client.query_workspace(
+        resp = await _get_logs_client().query_workspace(
             workspace_id,
-            query,
+            _shape_kql(query),
             timespan=dt.timedelta(minutes=30),
         )
     except Exception as ex:
         logging.error("Failed to query logs: %s", ex)
-        return []
+        return _empty_logs()
 
     if resp.status == LogsQueryStatus.PARTIAL:
         table = resp.partial_data[0]
@@ -93,35 +207,253 @@ def _run_kql(workspace_id: str, query: str) -> list[dict]:
     else:
         table = None
 
-    rows: list[dict] = []
-    if table:
-        cols = [c.name for c in table.columns]
-        for r in table.rows:
-            rows.append(dict(zip(cols, r)))
-    return rows
+    if not table:
+        return _empty_logs()
+    return {
+        "columns": [c.name for c in table.columns],
+        "rows": [list(r) for r in table.rows],
+    }
 
 
-def _rag_search(client: SearchClient, query: str, top_k: int = 5) -> list[dict]:
-    """Perform a semantic search against Cognitive Search and return a list of
-    document dictionaries.
+def _bind_doc_fields(doc: dict) -> list[tuple[str, Callable[[dict], object]]]:
+    """Resolve the index schema from the first search result.
+
+    Indexes name the id and body fields either ``id``/``content`` or
+    ``doc_id``/``chunk``; the choice is made once and bound to getters
+    that are reused for the remaining results.
     """
-    results = client.search(
+    id_key = "id" if "id" in doc else "doc_id"
+    content_key = "content" if "content" in doc else "chunk"
+    return [
+        ("id", itemgetter(id_key)),
+        ("title", itemgetter("title")),
+        ("content", itemgetter(content_key)),
+        ("url", itemgetter("url")),
+    ]
+
+
+async def _fetch_docs(
+    client: SearchClient,
+    query: str,
+    top_k: int,
+    vector_queries: list[VectorizedQuery] | None,
+) -> list[dict]:
+    """Run one search request and normalise the result documents."""
+    results = await client.search(
         search_text=query,
+        vector_queries=vector_queries,
         top=top_k,
         include_total_count=False,
     )
     docs = []
-    for doc in results:
-        docs.append({
-            "id": doc.get("id") or doc.get("doc_id") or "",
-            "title": doc.get("title") or "",
-            "content": doc.get("content") or doc.get("chunk") or "",
-            "url": doc.get("url") or ""
-        })
+    fields = None
+    async for doc in results:
+        if fields is None:
+            fields = _bind_doc_fields(doc)
+        row = {}
+        for name, get in fields:
+            try:
+                row[name] = get(doc) or ""
+            except KeyError:
+                row[name] = ""
+        docs.append(row)
     return docs
 
 
-def _build_prompt(user_question: str, logs_sample: list[dict], kb_docs: list[dict]) -> tuple[str, str]:
+async def _rag_search(
+    client: SearchClient,
+    query: str,
+    top_k: int = 5,
+    query_emb: list[float] | None = None,
+    vector_field: str | None = None,
+) -> list[dict]:
+    """Perform a semantic search against Cognitive Search and return a list of
+    document dictionaries.
+
+    When a ``vector_field`` is configured and a query embedding is
+    available a hybrid search is issued: the keyword query is combined
+    with an approximate nearest-neighbour query against the HNSW-indexed
+    field.  If the service rejects the vector query (e.g. the field is
+    missing or has another dimension) the search is retried keyword-only.
+    """
+    if vector_field and query_emb is not None:
+        vector_queries = [
+            VectorizedQuery(vector=query_emb, k_nearest_neighbors=top_k, fields=vector_field)
+        ]
+        try:
+            return await _fetch_docs(client, query, top_k, vector_queries)
+        except HttpResponseError as ex:
+            logging.warning("Vector search on %s failed, retrying keyword only: %s", vector_field, ex)
+    return await _fetch_docs(client, query, top_k, None)
+
+
+class SemanticCache:
+    """In-process cache of RAG results keyed by query embedding.
+
+    Query embeddings are L2-normalised and stored in a FAISS inner-product
+    index, so a lookup is a cosine-similarity nearest-neighbour search.  A
+    hit requires a similarity of at least ``threshold`` and an entry
+    younger than ``ttl`` seconds.  When ``maxsize`` is reached the least
+    recently used entry is evicted.  The index is sized from the first
+    embedding stored, so any embedding model can be used; if the
+    dimension changes (a different model was configured) the cache is
+    cleared and rebuilt at the new size.
+    """
+
+    def __init__(self, threshold: float = 0.9, ttl: float = 300.0, maxsize: int = 256) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._index: faiss.IndexFlatIP | None = None
+        self._entries: list[tuple[np.ndarray, list[dict], float]] = []
+        self._last_used: list[float] = []
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> np.ndarray:
+        vec = np.asarray(embedding, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def _rebuild(self) -> None:
+        self._index.reset()
+        if self._entries:
+            self._index.add(np.vstack([e[0] for e in self._entries]))
+
+    def get(self, query_emb: list[float]) -> list[dict] | None:
+        """Return cached documents for a sufficiently similar query, if any."""
+        if not self._entries or len(query_emb) != self._index.d:
+            return None
+        scores, ids = self._index.search(self._normalize(query_emb), 1)
+        idx = int(ids[0][0])
+        if idx < 0 or scores[0][0] < self.threshold:
+            return None
+        now = time.monotonic()
+        _, docs, created = self._entries[idx]
+        if now - created > self.ttl:
+            return None
+        self._last_used[idx] = now
+        return docs
+
+    def put(self, query_emb: list[float], docs: list[dict]) -> None:
+        """Store the documents retrieved for a query embedding."""
+        if self._index is None or len(query_emb) != self._index.d:
+            self._index = faiss.IndexFlatIP(len(query_emb))
+            self._entries = []
+            self._last_used = []
+        now = time.monotonic()
+        keep = [i for i, e in enumerate(self._entries) if now - e[2] <= self.ttl]
+        if len(keep) >= self.maxsize:
+            keep.remove(min(keep, key=self._last_used.__getitem__))
+        vec = self._normalize(query_emb)
+        if len(keep) != len(self._entries):
+            self._entries = [self._entries[i] for i in keep]
+            self._last_used = [self._last_used[i] for i in keep]
+            self._rebuild()
+        self._entries.append((vec[0], docs, now))
+        self._last_used.append(now)
+        self._index.add(vec)
+
+
+# One cache per search configuration, so changing the index, endpoint or
+# query shape never serves documents retrieved under the old settings.
+_RAG_CACHES: dict[tuple, SemanticCache] = {}
+
+
+async def _embed_many(texts: list[str], endpoint: str, api_key: str, deployment: str) -> dict[str, list[float]]:
+    """Embed several texts in a single batched call to Azure OpenAI.
+
+    Duplicate texts are embedded once.  Returns a dictionary mapping each
+    input text to its embedding, or an empty dictionary if the call fails
+    so callers can fall back to an uncached search.
+    """
+    unique = list(dict.fromkeys(t for t in texts if t))
+    if not unique:
+        return {}
+    try:
+        client = _get_openai_client(endpoint, api_key)
+        response = await client.embeddings.create(model=deployment, input=unique)
+        return {unique[item.index]: item.embedding for item in response.data}
+    except Exception as ex:
+        logging.error("Embedding call failed: %s", ex)
+        return {}
+
+
+async def _cached_rag_search(
+    client: SearchClient,
+    query: str,
+    query_emb: list[float] | None,
+    top_k: int = 5,
+    vector_field: str | None = None,
+) -> list[dict]:
+    """Serve the RAG search from the semantic cache when a similar query
+    was answered recently, otherwise search and populate the cache.
+    """
+    # Search clients are shared per (endpoint, index, key), so the client
+    # itself identifies the index being queried.
+    cache = _RAG_CACHES.setdefault((client, top_k, vector_field), SemanticCache())
+    if query_emb is not None:
+        docs = cache.get(query_emb)
+        if docs is not None:
+            return docs
+    docs = await _rag_search(client, query, top_k=top_k, query_emb=query_emb, vector_field=vector_field)
+    if query_emb is not None and docs:
+        cache.put(query_emb, docs)
+    return docs
+
+
+# Token budget for the knowledge base section of the prompt, shared across
+# the retrieved documents.  If the tokenizer cannot be loaded (its BPE file
+# is downloaded on first use) each document is cut to a character cap.
+_KB_TOKEN_BUDGET = 2000
+_KB_DOC_CHARS = 1000
+_ENCODING: tiktoken.Encoding | None = None
+_ENCODING_FAILED = False
+
+
+def _get_encoding() -> tiktoken.Encoding | None:
+    """Return the tokenizer used to measure prompt snippets, or ``None``
+    if it could not be loaded.
+    """
+    global _ENCODING, _ENCODING_FAILED
+    if _ENCODING is None and not _ENCODING_FAILED:
+        try:
+            _ENCODING = tiktoken.encoding_for_model("gpt-4o")
+        except Exception as ex:
+            logging.warning("Tokenizer unavailable, using character cap: %s", ex)
+            _ENCODING_FAILED = True
+    return _ENCODING
+
+
+def _build_kb_snippets(kb_docs: list[dict], budget: int = _KB_TOKEN_BUDGET) -> str:
+    """Render the retrieved documents for the prompt within a token budget.
+
+    Each document gets an equal share of what is left of the budget, so
+    short documents pass their unused tokens on to the ones after them.
+    """
+    enc = _get_encoding()
+    buf = io.StringIO()
+    remaining = budget
+    for i, d in enumerate(kb_docs):
+        if i:
+            buf.write("\n\n")
+        buf.write(f"TITLE: {d['title']}\nCONTENT:\n")
+        if enc is None:
+            buf.write(d["content"][:_KB_DOC_CHARS])
+            continue
+        share = remaining // (len(kb_docs) - i)
+        # Tokens average about four characters, so eight characters per
+        # token of share fills it without encoding the whole document.
+        tokens = enc.encode(d["content"][:share * 8], disallowed_special=())
+        if len(tokens) > share:
+            buf.write(enc.decode(tokens[:share]))
+            remaining -= share
+        else:
+            buf.write(d["content"][:share * 8])
+            remaining -= len(tokens)
+    return buf.getvalue()
+
+
+def _build_prompt(user_question: str, logs_sample: dict, kb_docs: list[dict]) -> tuple[str, str]:
     """Construct the system and user messages for the OpenAI call.
     
     The system message describes the agent’s responsibilities.  The user
@@ -131,11 +463,16 @@ def _build_prompt(user_question: str, logs_sample: list[dict], kb_docs: list[dic
     evidence.
     """
     # Build RAG context from docs
-    kb_snippets = "\n\n".join(
-        [f"TITLE: {d['title']}\nCONTENT:\n{d['content'][:1000]}" for d in kb_docs]
-    )
+    kb_snippets = _build_kb_snippets(kb_docs)
     # Sample logs to avoid exceeding token limits
-    logs_preview = json.dumps(logs_sample[:20], indent=2)
+    logs_preview = orjson.dumps(
+        {
+            "columns": logs_sample.get("columns", []),
+            "rows": logs_sample.get("rows", [])[:_KQL_PREVIEW_ROWS],
+        },
+        option=orjson.OPT_INDENT_2,
+        default=str,
+    ).decode()
 
     system = (
         "You are an AIOps reasoning agent. You must:\n"
@@ -162,33 +499,132 @@ def _build_prompt(user_question: str, logs_sample: list[dict], kb_docs: list[dic
     return system, user
 
 
-def _call_openai(system: str, user: str, endpoint: str, deployment: str, api_key: str) -> dict:
+class _ActionsScanner:
+    """Incrementally scan a streamed JSON plan for the top-level ``actions``
+    array.
+
+    Characters are consumed once as they arrive; string literals and
+    escapes are tracked so brackets inside text do not affect the depth.
+    ``feed`` returns the parsed actions list the first time the array is
+    closed and ``None`` otherwise.
+    """
+
+    def __init__(self) -> None:
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._str_start = 0
+        self._last_str: str | None = None
+        self._start: int | None = None
+        self.done = False
+
+    def feed(self, buffer: str) -> list[dict] | None:
+        if self.done:
+            return None
+        for i in range(self._pos, len(buffer)):
+            ch = buffer[i]
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+                    self._last_str = buffer[self._str_start:i]
+                continue
+            if ch == '"':
+                self._in_str = True
+                self._str_start = i + 1
+            elif ch in "{[":
+                if ch == "[" and self._depth == 1 and self._last_str == "actions":
+                    self._start = i
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._start is not None and self._depth == 1:
+                    self.done = True
+                    try:
+                        return orjson.loads(buffer[self._start:i + 1])
+                    except ValueError:
+                        return None
+            elif ch == ",":
+                self._last_str = None
+        self._pos = len(buffer)
+        return None
+
+
+# Output cap for the plan.  It leaves room for the summary, actions and KQL
+# evidence; a plan that still hits it is reported as truncated.
+_PLAN_MAX_TOKENS = 1500
+
+
+async def _call_openai(
+    system: str,
+    user: str,
+    endpoint: str,
+    deployment: str,
+    api_key: str,
+    on_actions: Callable[[list[dict]], None] | None = None,
+) -> dict:
     """Call Azure OpenAI to generate the analysis plan.
     
-    The function sets up the appropriate configuration and expects the
-    model to return a JSON string which is parsed and returned as a
-    dictionary.  Any parsing errors are logged and a fallback is
-    returned.
+    JSON mode is requested so the model always emits a parseable object,
+    and the output length is capped to bound tail latency.  The response
+    is streamed and accumulated chunk by chunk.  As soon as the
+    ``actions`` array of the plan is complete, ``on_actions`` (if given)
+    is invoked with it so remediation can start while the rest of the
+    plan is still being generated.  The full JSON string is then
+    parsed and returned as a dictionary.  Any errors are logged and a
+    fallback is returned; if actions were already dispatched the fallback
+    carries them and states that the analysis is incomplete.
     """
-    openai.api_type = "azure"
-    openai.api_base = endpoint
-    openai.api_version = "2024-02-01"
-    openai.api_key = api_key
-
+    scanner = _ActionsScanner()
+    dispatched: list[dict] | None = None
     try:
-        response = openai.ChatCompletion.create(
-            engine=deployment,
+        client = _get_openai_client(endpoint, api_key)
+        response = await client.chat.completions.create(
+            model=deployment,
             messages=[
                 {"role": "system", "content": system},
                 {"role": "user", "content": user},
             ],
             temperature=0.2,
+            response_format={"type": "json_object"},
+            max_tokens=_PLAN_MAX_TOKENS,
+            stream=True,
         )
-        content = response["choices"][0]["message"]["content"]
-        plan = json.loads(content)
-        return plan
+        content = ""
+        finish_reason = None
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            delta = choice.delta.content
+            if not delta:
+                continue
+            content += delta
+            if on_actions and not scanner.done:
+                actions = scanner.feed(content)
+                if actions is not None:
+                    dispatched = actions
+                    on_actions(actions)
+        if finish_reason == "length":
+            raise ValueError(f"plan truncated at max_tokens={_PLAN_MAX_TOKENS}")
+        return orjson.loads(content)
     except Exception as ex:
         logging.error("OpenAI call failed: %s", ex)
+        if dispatched is not None:
+            # Remediation has already started from the streamed actions, so
+            # keep them in the plan the results are reported against.
+            return {
+                "rca_summary": "Analysis incomplete: the model response ended after its actions were dispatched.",
+                "confidence": 0.0,
+                "actions": dispatched,
+                "evidence": {}
+            }
         return {
             "rca_summary": "Unable to generate analysis due to error.",
             "confidence": 0.0,
@@ -197,106 +633,199 @@ def _call_openai(system: str, user: str, endpoint: str, deployment: str, api_key
         }
 
 
-def _maybe_remediate(plan: dict, remediation_url: str, remediation_key: str | None = None) -> list[dict]:
+# Risk levels that are executed without human approval.
+_ACCEPT_RISKS = frozenset({"low", "medium"})
+
+# Recently dispatched (action, params) pairs; identical actions proposed
+# again within the TTL are not re-posted to the remediation endpoint.
+_RECENT_ACTIONS: cachetools.TTLCache = cachetools.TTLCache(maxsize=1024, ttl=60)
+
+
+async def _maybe_remediate(plan: dict, remediation_url: str, remediation_key: str | None = None) -> list[dict]:
     """Execute remediation actions with low or medium risk via HTTP POST.
     
     A simple policy is applied: low and medium risk actions are executed
     immediately, high risk actions are skipped for later approval.  The
-    results of each POST are captured for audit.
+    accepted actions are posted concurrently over the shared HTTP client
+    and the results of each POST are captured for audit.  An action whose
+    name and parameters match one dispatched in the last minute is
+    reported as ``deduped`` instead of being posted again.
     """
-    results = []
+    results: list[dict | None] = []
+    pending: list[tuple[int, str, bytes]] = []
+    payloads: list[dict] = []
     for act in plan.get("actions", []):
         name = act.get("name")
         params = act.get("params", {})
-        risk = (act.get("risk") or "").lower()
-        if risk in ("low", "medium") and remediation_url:
-            payload = {"action": name, "params": params}
-            headers = {"Content-Type": "application/json"}
-            if remediation_key:
-                headers["x-functions-key"] = remediation_key
-            try:
-                resp = requests.post(remediation_url, headers=headers, json=payload, timeout=20)
-                results.append({
-                    "action": name,
-                    "status": resp.status_code,
-                    "response": resp.text[:300]
-                })
-            except Exception as ex:
+        risk = act.get("risk")
+        if risk and risk.lower() in _ACCEPT_RISKS and remediation_url:
+            # Serialised so the key is hashable whatever JSON the model emits.
+            key = orjson.dumps([name, params], option=orjson.OPT_SORT_KEYS)
+            if key in _RECENT_ACTIONS:
                 results.append({
                     "action": name,
-                    "status": "error",
-                    "response": str(ex)
+                    "status": "deduped",
+                    "reason": "identical action dispatched within the last 60 seconds"
                 })
+                continue
+            _RECENT_ACTIONS[key] = True
+            pending.append((len(results), name, key))
+            payloads.append({"action": name, "params": params})
+            results.append(None)
         else:
             results.append({
                 "action": name,
                 "status": "skipped",
                 "reason": "risk too high or remediation endpoint missing"
             })
+
+    if payloads:
+        headers = {"Content-Type": "application/json"}
+        if remediation_key:
+            headers["x-functions-key"] = remediation_key
+
+        responses = await asyncio.gather(
+            *[_HTTP.post(remediation_url, headers=headers, json=payload) for payload in payloads],
+            return_exceptions=True,
+        )
+        for (idx, name, key), outcome in zip(pending, responses):
+            if isinstance(outcome, BaseException) or not outcome.is_success:
+                # Let a failed dispatch be retried straight away.
+                _RECENT_ACTIONS.pop(key, None)
+            if isinstance(outcome, BaseException):
+                results[idx] = {
+                    "action": name,
+                    "status": "error",
+                    "response": str(outcome)
+                }
+            else:
+                results[idx] = {
+                    "action": name,
+                    "status": outcome.status_code,
+                    "response": outcome.text[:300]
+                }
     return results
 
 
-def _build_adaptive_card(plan: dict, incident: dict) -> dict:
+def _compile_card_template(card: dict) -> str:
+    """Serialise a card layout into a ``str.format_map`` template.
+
+    Literal JSON braces are doubled so only the ``{name}`` placeholders
+    embedded in the layout's string values remain as format fields.
+    """
+    text = orjson.dumps(card).decode().replace("{", "{{").replace("}", "}}")
+    return re.sub(r"\{\{(\w+)\}\}", r"{\1}", text)
+
+
+# The Adaptive Card is serialised once at import time; each request only
+# fills the placeholders with JSON-escaped values.
+_CARD_TMPL = _compile_card_template({
+    "$schema": "https://adaptivecards.io/schemas/adaptive-card.json",
+    "type": "AdaptiveCard",
+    "version": "1.5",
+    "msteams": {"width": "Full"},
+    "body": [
+        {"type": "TextBlock", "text": "RCA: {title}", "wrap": True, "size": "Large", "weight": "Bolder"},
+        {"type": "TextBlock", "text": "Environment: {environment} • Severity: {severity} • Started: {start_time_local}", "wrap": True, "isSubtle": True},
+        {
+            "type": "FactSet",
+            "facts": [
+                {"title": "Incident ID", "value": "{id}"},
+                {"title": "Service", "value": "{service_name}"},
+                {"title": "Region", "value": "{region}"},
+                {"title": "Change Correlation", "value": "{change_ref}"},
+            ],
+        },
+        {"type": "TextBlock", "text": "Suspected Root Cause", "weight": "Bolder", "spacing": "Medium"},
+        {"type": "TextBlock", "text": "{rca_summary}", "wrap": True},
+        {"type": "TextBlock", "text": "Actions Executed", "weight": "Bolder", "spacing": "Medium"},
+        {"type": "TextBlock", "text": "{actions_text}", "wrap": True},
+        {"type": "TextBlock", "text": "KQL & Evidence", "weight": "Bolder", "spacing": "Medium"},
+        {
+            "type": "RichTextBlock",
+            "inlines": [
+                {"type": "TextRun", "text": "KQL: ", "weight": "Bolder"},
+                {"type": "TextRun", "text": "{kql_name}", "isSubtle": True},
+            ],
+        },
+        {"type": "TextBlock", "text": "{kql}", "wrap": True, "fontType": "Monospace"},
+        {
+            "type": "RichTextBlock",
+            "inlines": [
+                {"type": "TextRun", "text": "Evidence: ", "weight": "Bolder"},
+                {"type": "TextRun", "text": "{links}", "isSubtle": True},
+            ],
+        },
+    ],
+    "actions": [
+        {"type": "Action.OpenUrl", "title": "View Dashboard", "url": "{dashboard_url}"},
+        {"type": "Action.OpenUrl", "title": "Open Incident", "url": "{incident_url}"},
+    ],
+})
+
+
+class _SafeDict(dict):
+    """Template context that JSON-escapes values and renders missing keys
+    as empty strings.
+    """
+
+    def __init__(self, values: dict) -> None:
+        super().__init__((k, orjson.dumps(str(v)).decode()[1:-1]) for k, v in values.items())
+
+    def __missing__(self, key: str) -> str:
+        return ""
+
+
+@functools.lru_cache(maxsize=256)
+def _incident_card_fields(incident_blob: bytes) -> _SafeDict:
+    """Return the escaped incident fields of the card.
+
+    Agents often invoke the function repeatedly for the same incident, so
+    the result is memoised on the serialised incident.  The returned
+    mapping is shared between calls and must not be mutated.
+    """
+    incident = orjson.loads(incident_blob)
+    return _SafeDict({
+        "title": incident.get("title", ""),
+        "environment": incident.get("environment", ""),
+        "severity": incident.get("severity", ""),
+        "start_time_local": incident.get("start_time_local", ""),
+        "id": incident.get("id", ""),
+        "service_name": incident.get("service_name", ""),
+        "region": incident.get("region", ""),
+        "change_ref": incident.get("change_ref", "n/a"),
+        "dashboard_url": incident.get("dashboard_url", "https://"),
+        "incident_url": incident.get("incident_url", "https://"),
+    })
+
+
+def _build_adaptive_card(plan: dict, incident: dict) -> bytes:
     """Construct an Adaptive Card payload for Teams from the analysis plan.
 
     The card summarises the incident context, suspected root cause,
     actions and evidence.  Links to dashboards or incidents are passed
-    through from the incident context dictionary.
+    through from the incident context dictionary.  The card is returned
+    already serialised as UTF-8 encoded JSON.
     """
-    kql = plan.get("evidence", {}).get("kql_snippet", "")
-    kql_name = plan.get("evidence", {}).get("kql_name", "")
-    links = ", ".join(plan.get("evidence", {}).get("links", []))
+    evidence = plan.get("evidence", {})
     actions_text = "\n".join([
-        f"• {a.get('name')} {json.dumps(a.get('params', {}))}" for a in plan.get("actions", [])
+        f"• {a.get('name')} {orjson.dumps(a.get('params', {})).decode()}" for a in plan.get("actions", [])
     ])
+    ctx = _SafeDict({
+        "rca_summary": plan.get("rca_summary", ""),
+        "actions_text": actions_text,
+        "kql_name": evidence.get("kql_name", ""),
+        "kql": evidence.get("kql_snippet", ""),
+        "links": ", ".join(evidence.get("links", [])),
+    })
+    ctx.update(_incident_card_fields(orjson.dumps(incident, option=orjson.OPT_SORT_KEYS)))
+    return _CARD_TMPL.format_map(ctx).encode()
 
-    card = {
-        "$schema": "https://adaptivecards.io/schemas/adaptive-card.json",
-        "type": "AdaptiveCard",
-        "version": "1.5",
-        "msteams": {"width": "Full"},
-        "body": [
-            {"type": "TextBlock", "text": f"RCA: {incident['title']}", "wrap": True, "size": "Large", "weight": "Bolder"},
-            {"type": "TextBlock", "text": f"Environment: {incident['environment']} • Severity: {incident['severity']} • Started: {incident['start_time_local']}", "wrap": True, "isSubtle": True},
-            {
-                "type": "FactSet",
-                "facts": [
-                    {"title": "Incident ID", "value": incident.get("id", "")},
-                    {"title": "Service", "value": incident.get("service_name", "")},
-                    {"title": "Region", "value": incident.get("region", "")},
-                    {"title": "Change Correlation", "value": incident.get("change_ref", "n/a")},
-                ],
-            },
-            {"type": "TextBlock", "text": "Suspected Root Cause", "weight": "Bolder", "spacing": "Medium"},
-            {"type": "TextBlock", "text": plan.get("rca_summary", ""), "wrap": True},
-            {"type": "TextBlock", "text": "Actions Executed", "weight": "Bolder", "spacing": "Medium"},
-            {"type": "TextBlock", "text": actions_text, "wrap": True},
-            {"type": "TextBlock", "text": "KQL & Evidence", "weight": "Bolder", "spacing": "Medium"},
-            {
-                "type": "RichTextBlock",
-                "inlines": [
-                    {"type": "TextRun", "text": "KQL: ", "weight": "Bolder"},
-                    {"type": "TextRun", "text": kql_name, "isSubtle": True},
-                ],
-            },
-            {"type": "TextBlock", "text": kql, "wrap": True, "fontType": "Monospace"},
-            {
-                "type": "RichTextBlock",
-                "inlines": [
-                    {"type": "TextRun", "text": "Evidence: ", "weight": "Bolder"},
-                    {"type": "TextRun", "text": links, "isSubtle": True},
-                ],
-            },
-        ],
-        "actions": [
-            {"type": "Action.OpenUrl", "title": "View Dashboard", "url": incident.get("dashboard_url", "https://")},
-            {"type": "Action.OpenUrl", "title": "Open Incident", "url": incident.get("incident_url", "https://")},
-        ],
-    }
-    return card
+
+_TEAMS_HEADERS = {"Content-Type": "application/json"}
 
 
-def _post_to_teams(card_json: dict, webhook_url: str) -> int | None:
+async def _post_to_teams(card_bytes: bytes, webhook_url: str) -> int | None:
     """Send the Adaptive Card to a Teams incoming webhook.
 
     Returns the HTTP status code if the post is attempted, otherwise None
@@ -306,8 +835,7 @@ def _post_to_teams(card_json: dict, webhook_url: str) -> int | None:
         logging.warning("No Teams webhook configured, skipping card post.")
         return None
     try:
-        headers = {"Content-Type": "application/json"}
-        response = requests.post(webhook_url, headers=headers, data=json.dumps(card_json), timeout=15)
+        response = await _HTTP.post(webhook_url, headers=_TEAMS_HEADERS, content=card_bytes, timeout=15)
         return response.status_code
     except Exception as ex:
         logging.error("Failed to post to Teams: %s", ex)
@@ -349,39 +877,73 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
 
     # Read env vars
     workspace_id = os.getenv("LOG_ANALYTICS_WORKSPACE_ID", "")
-    kql_query = os.getenv(
-        "KQL_QUERY",
-        "AppTraces | where Timestamp > ago(30m) | take 100"
-    )
+    kql_query = os.getenv("KQL_QUERY", _DEFAULT_KQL_QUERY)
     search_endpoint = os.getenv("SEARCH_ENDPOINT", "")
     search_index = os.getenv("SEARCH_INDEX", "")
     search_api_key = os.getenv("SEARCH_API_KEY", "")
+    search_vector_field = os.getenv("SEARCH_VECTOR_FIELD", "")
     openai_endpoint = os.getenv("OPENAI_ENDPOINT", "")
     openai_api_key = os.getenv("OPENAI_API_KEY", "")
     openai_deployment = os.getenv("OPENAI_DEPLOYMENT", "")
+    openai_embedding_deployment = os.getenv("OPENAI_EMBEDDING_DEPLOYMENT", "")
     teams_webhook = os.getenv("TEAMS_WEBHOOK_URL", "")
     remediation_url = os.getenv("REMEDIATION_URL", "")
     remediation_key = os.getenv("REMEDIATION_KEY", None)
+    pretty_json = os.getenv("PRETTY_JSON") == "1"
+
+    # 1) + 2) Query logs via KQL and run the RAG search concurrently; the
+    # two legs are independent so wall-clock time is max(kql, rag).
+    kql_task = asyncio.create_task(
+        _run_kql(workspace_id, kql_query) if workspace_id else _no_logs()
+    )
 
-    # 1) Query logs via KQL
-    logs_sample = _run_kql(workspace_id, kql_query) if workspace_id else []
+    async def _search_kb() -> list[dict]:
+        # Every text that needs a vector is embedded in one batched call.
+        embeddings: dict[str, list[float]] = {}
+        if openai_endpoint and openai_api_key and openai_embedding_deployment:
+            embeddings = await _embed_many(
+                [question], openai_endpoint, openai_api_key, openai_embedding_deployment
+            )
+        return await _cached_rag_search(
+            _get_search_client(search_endpoint, search_index, search_api_key),
+            question,
+            embeddings.get(question),
+            top_k=5,
+            vector_field=search_vector_field,
+        )
 
-    # 2) RAG search
-    kb_docs: list[dict] = []
-    if search_endpoint and search_index and search_api_key:
-        search_client = SearchClient(
-            endpoint=search_endpoint,
-            index_name=search_index,
-            credential=AzureKeyCredential(search_api_key),
+    rag_task = asyncio.create_task(
+        _search_kb() if search_endpoint and search_index and search_api_key else _no_results()
+    )
+    try:
+        logs_sample, kb_docs = await asyncio.gather(kql_task, rag_task)
+    except BaseException:
+        # gather does not cancel the sibling leg when one of them fails.
+        kql_task.cancel()
+        rag_task.cancel()
+        raise
+
+    # 3) + 4) Call LLM and execute remediation for low/medium risk.  The
+    # remediation is dispatched as soon as the streamed plan's actions
+    # array closes, overlapping it with the rest of the generation.
+    remediation_task: asyncio.Task | None = None
+
+    def _dispatch_remediation(actions: list[dict]) -> None:
+        nonlocal remediation_task
+        remediation_task = asyncio.create_task(
+            _maybe_remediate({"actions": actions}, remediation_url, remediation_key)
         )
-        kb_docs = _rag_search(search_client, question, top_k=5)
 
-    # 3) Call LLM
     system_msg, user_msg = _build_prompt(question, logs_sample, kb_docs)
-    plan = _call_openai(system_msg, user_msg, openai_endpoint, openai_deployment, openai_api_key)
+    plan = await _call_openai(
+        system_msg, user_msg, openai_endpoint, openai_deployment, openai_api_key,
+        on_actions=_dispatch_remediation,
+    )
 
-    # 4) Execute remediation for low/medium risk
-    results = _maybe_remediate(plan, remediation_url, remediation_key)
+    if remediation_task is not None:
+        results = await remediation_task
+    else:
+        results = await _maybe_remediate(plan, remediation_url, remediation_key)
     # Append results to plan actions for transparency
     if results:
         plan.setdefault("actions", [])
@@ -395,7 +957,7 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
 
     # 5) Build and post Teams card
     card_payload = _build_adaptive_card(plan, incident_ctx)
-    status = _post_to_teams(card_payload, teams_webhook)
+    status = await _post_to_teams(card_payload, teams_webhook)
 
     # Build response
     response_body = {
@@ -405,6 +967,7 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         "kb_docs_used": [d["title"] for d in kb_docs],
     }
     return func.HttpResponse(
-        json.dumps(response_body, indent=2),
+        body=orjson.dumps(response_body, option=orjson.OPT_INDENT_2 if pretty_json else None),
         mimetype="application/json",
+        charset="utf-8",
     )
\ No newline at end of file
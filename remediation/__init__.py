@@ -12,7 +12,7 @@ with your own automation platform).
 """
 
 # Define the whitelist of safe actions.
-SAFE_ACTIONS: set[str] = {"scale_db", "toggle_feature_flag", "restart_service"}
+SAFE_ACTIONS: frozenset[str] = frozenset({"scale_db", "toggle_feature_flag", "restart_service"})
 
 
 async def main(req: func.HttpRequest) -> func.HttpResponse: